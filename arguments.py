@@ -56,6 +56,10 @@ class ModelArguments:
     use_HFBert: bool = field(
         default=False, metadata={"help": "Whether to use HFBert Encoder"}
     )
+    load_in_8bit: bool = field(
+        default=False,
+        metadata={"help": "Whether to load the reader in int8 with bitsandbytes"},
+    )
 
 
 @dataclass
@@ -2,12 +2,14 @@ import json
 import os
 import pickle
 import time
+from collections import Counter
 from contextlib import contextmanager
 from typing import List, Optional, Tuple, Union
 
 import faiss
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from datasets import Dataset, concatenate_datasets, load_from_disk
 from transformers import AutoTokenizer
 
@@ -99,6 +101,47 @@ class BM25PlusRetriever:
         self.bm25plus = BM25Plus(self.tokenized_contexts)
         print("Tokenized contexts fitted to BM25Plus.")
 
+        # 문서×단어 BM25+ 점수를 CSR 행렬로 미리 계산 (bm25s 스타일 eager scoring)
+        self._build_score_matrix()
+
+    def _build_score_matrix(self) -> None:
+        """
+        Summary:
+            BM25Plus의 tf 부분 점수를 (단어 × 문서) CSR 행렬로 미리 계산해 둡니다.
+            query 점수는 해당 단어 행들의 합이 되므로, rank_bm25의 문서 전체를 도는
+            파이썬 루프 대신 sparse 행렬곱 한 번으로 모든 문서 점수를 구할 수 있습니다.
+            delta 항은 문서와 무관한 상수라 query 쪽에서 따로 더해줍니다.
+        """
+        bm25 = self.bm25plus
+        vocab = {}
+        rows, cols, data = [], [], []
+        for doc_idx, freqs in enumerate(bm25.doc_freqs):
+            denom_const = bm25.k1 * (
+                1 - bm25.b + bm25.b * bm25.doc_len[doc_idx] / bm25.avgdl
+            )
+            for term, tf in freqs.items():
+                col = vocab.setdefault(term, len(vocab))
+                rows.append(doc_idx)
+                cols.append(col)
+                data.append(
+                    (bm25.idf.get(term) or 0)
+                    * (tf * (bm25.k1 + 1))
+                    / (denom_const + tf)
+                )
+
+        self.vocab = vocab
+        # query 상수항(delta) 계산용 단어별 idf
+        idf_arr = np.zeros(len(vocab), dtype=np.float64)
+        for term, col in vocab.items():
+            idf_arr[col] = bm25.idf.get(term) or 0
+        self.idf_arr = idf_arr
+
+        # (단어 × 문서) 방향으로 두어야 query쪽 행렬곱이 CSR 친화적
+        self.score_matrix = sparse.csr_matrix(
+            (data, (rows, cols)), shape=(len(bm25.doc_freqs), len(vocab))
+        ).T.tocsr()
+        print("BM25Plus sparse score matrix built.")
+
     def retrieve(
         self,
         query_or_dataset: Union[str, Dataset],
@@ -138,15 +181,9 @@ class BM25PlusRetriever:
             # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
             total = []
             with timer("BM25+ retrieval"):
-                doc_scores = []
-                doc_indices = []
-                for query in tqdm(
-                    query_or_dataset["question"],
-                    desc="Retrieving documents for all questions",
-                ):
-                    scores, indices = self.get_relevant_doc(query, k=topk)
-                    doc_scores.append(scores)
-                    doc_indices.append(indices)
+                doc_scores, doc_indices = self.get_relevant_doc_bulk(
+                    query_or_dataset["question"], k=topk
+                )
 
             for idx, example in enumerate(
                 tqdm(query_or_dataset, desc="Building result DataFrame")
@@ -190,17 +227,68 @@ class BM25PlusRetriever:
                 상위 몇 개의 Passage를 반환할지 정합니다.
         """
 
-        tokenized_query = self.tokenizer(query)["input_ids"][1:-1]
+        doc_scores, doc_indices = self.get_relevant_doc_bulk([query], k=k)
+        return doc_scores[0], doc_indices[0]
+
+    def get_relevant_doc_bulk(
+        self, queries: List, k: Optional[int] = 1, batch_size: int = 512
+    ) -> Tuple[List, List]:
+        """
+        Arguments:
+            queries (List):
+                여러 개의 Query를 받습니다.
+            k (Optional[int]): 1
+                상위 몇 개의 Passage를 반환할지 정합니다.
+            batch_size (int): 512
+                한 번에 점수를 계산할 query 개수입니다. (num_query × num_doc)
+                점수 행렬이 통째로 메모리에 올라가지 않게 합니다.
+
+        Summary:
+            query들을 count 벡터로 만들어 미리 계산된 BM25+ 점수 행렬과
+            sparse 행렬곱 한 번으로 모든 문서 점수를 구한 뒤,
+            np.argpartition으로 top-k만 골라냅니다.
+        """
 
-        scores = [
-            (val, idx)
-            for idx, val in enumerate(self.bm25plus.get_scores(tokenized_query))
+        # query들을 한 번의 batched 호출로 토큰화 (앞 [CLS], 뒤 [SEP] 토큰 제외)
+        tokenized_queries = [
+            ids[1:-1] for ids in self.tokenizer(list(queries))["input_ids"]
         ]
-        scores.sort(reverse=True)
-        scores = scores[:k]
 
-        doc_scores = [val for val, _ in scores]
-        doc_indices = [idx for _, idx in scores]
+        num_docs = self.score_matrix.shape[1]
+        doc_scores = []
+        doc_indices = []
+        for batch_start in tqdm(
+            range(0, len(tokenized_queries), batch_size),
+            desc="Retrieving documents for all questions",
+        ):
+            batch = tokenized_queries[batch_start : batch_start + batch_size]
+
+            # query count 벡터 구성 + 문서와 무관한 delta 상수항 계산
+            rows, cols, data = [], [], []
+            consts = np.zeros(len(batch), dtype=np.float64)
+            for row_idx, token_ids in enumerate(batch):
+                for term, count in Counter(token_ids).items():
+                    col = self.vocab.get(term)
+                    if col is None:
+                        continue
+                    rows.append(row_idx)
+                    cols.append(col)
+                    data.append(count)
+                    consts[row_idx] += count * self.idf_arr[col] * self.bm25plus.delta
+
+            q_mat = sparse.csr_matrix(
+                (data, (rows, cols)), shape=(len(batch), len(self.vocab))
+            )
+            scores = (q_mat @ self.score_matrix).toarray() + consts[:, None]
+
+            # top-k만 O(N)으로 골라낸 뒤 그 안에서만 정렬
+            top_idx = np.argpartition(-scores, min(k, num_docs - 1), axis=1)[:, :k]
+            for row_idx in range(len(batch)):
+                row_top = top_idx[row_idx][
+                    np.argsort(-scores[row_idx][top_idx[row_idx]])
+                ]
+                doc_scores.append(scores[row_idx][row_top].tolist())
+                doc_indices.append(row_top.tolist())
 
         return doc_scores, doc_indices
 
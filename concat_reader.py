@@ -11,7 +11,11 @@ from torch.utils.data import Dataset
 import numpy as np
 from datasets import Dataset, DatasetDict, Features, Value
 from arguments import DataTrainingArguments, ModelArguments
-from utils_qa import check_no_error, postprocess_qa_predictions
+from utils_qa import (
+    check_no_error,
+    postprocess_qa_predictions,
+    prepare_validation_features,
+)
 from typing import Dict, Tuple
 from trainer_qa import QuestionAnsweringTrainer
 import evaluate
@@ -79,50 +83,21 @@ if __name__ == "__main__":
         data_args, training_args, datasets, tokenizer
     )
 
-    # Validation preprocessing / 전처리를 진행합니다.
-    def prepare_validation_features(examples):
-        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
-        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
-        tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            stride=data_args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            return_token_type_ids=False,  # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
-            padding="max_length" if data_args.pad_to_max_length else False,
-        )
-
-        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-
-        # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
-        # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
-        tokenized_examples["example_id"] = []
-
-        for i in range(len(tokenized_examples["input_ids"])):
-            # sequence id를 설정합니다 (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
-
-            # 하나의 example이 여러개의 span을 가질 수 있습니다.
-            sample_index = sample_mapping[i]
-            tokenized_examples["example_id"].append(examples["id"][sample_index])
-
-            # context의 일부가 아닌 offset_mapping을 None으로 설정하여 토큰 위치가 컨텍스트의 일부인지 여부를 쉽게 판별할 수 있습니다.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
-        return tokenized_examples
-
     eval_dataset = datasets["validation"]
 
     # Validation Feature 생성
+    # module-level 함수 + fn_kwargs 조합이라 fingerprint가 안정적이고 캐시가 재사용됩니다.
     eval_dataset = eval_dataset.map(
         prepare_validation_features,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "question_column_name": question_column_name,
+            "context_column_name": context_column_name,
+            "max_seq_length": max_seq_length,
+            "doc_stride": data_args.doc_stride,
+            "pad_on_right": pad_on_right,
+            "pad_to_max_length": data_args.pad_to_max_length,
+        },
         batched=True,
         num_proc=data_args.preprocessing_num_workers,
         remove_columns=column_names,
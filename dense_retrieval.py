@@ -1,5 +1,6 @@
 from datasets import load_from_disk
 from transformers import AutoTokenizer
+import faiss
 import numpy as np
 from tqdm import tqdm
 import random
@@ -170,6 +171,7 @@ class DenseRetriever:
         self.contexts = list(dict.fromkeys([v["text"] for v in wiki.values()]))
         print(f"Lengths of unique contexts : {len(self.contexts)}")
         self.ids = list(range(len(self.contexts)))
+        self.indexer = None  # build_faiss()로 생성합니다.
 
     def train(self, args):
         if not self.use_neg_sampling:
@@ -451,6 +453,79 @@ class DenseRetriever:
             with open(wiki_emb_path, "wb") as file:
                 pickle.dump(p_embs, file)
 
+    def build_faiss(self, num_clusters=None):
+        """
+        Summary:
+            wiki passage 임베딩을 IVF-PQ FAISS 인덱스에 fitting 시켜놓습니다.
+            전체 임베딩 행렬과의 exhaustive matmul 대신 IVF로 후보 cluster만 보고
+            PQ로 벡터를 8bit 코드로 압축해 메모리 대역폭을 줄입니다.
+            한 번 build한 인덱스는 파일로 저장해 두고 다음에 불러옵니다.
+        """
+        p_embs = np.asarray(self.p_embs, dtype=np.float32)
+        num_passages, emb_dim = p_embs.shape
+        if num_clusters is None:
+            # 관례적인 4*sqrt(N) 개의 cluster
+            num_clusters = int(4 * np.sqrt(num_passages))
+
+        indexer_path = f"../data/dense_faiss_ivfpq{num_clusters}.index"
+        if os.path.isfile(indexer_path):
+            print("Load Saved Dense Faiss Indexer.")
+            self.indexer = faiss.read_index(indexer_path)
+        else:
+            print("Building Dense Faiss Indexer.")
+            quantizer = faiss.IndexFlatIP(emb_dim)
+            self.indexer = faiss.IndexIVFPQ(
+                quantizer,
+                emb_dim,
+                num_clusters,
+                emb_dim // 8,
+                8,
+                faiss.METRIC_INNER_PRODUCT,
+            )
+            self.indexer.train(p_embs)
+            self.indexer.add(p_embs)
+            faiss.write_index(self.indexer, indexer_path)
+            print("Dense Faiss Indexer Saved.")
+        self.indexer.nprobe = 16
+
+    # 여러 query를 배치로 인코딩해서 faiss 인덱스로 top-k 문서를 찾는 함수
+    def get_relevant_docs_bulk(self, queries, k, batch_size=64):
+        with torch.no_grad():
+            self.q_encoder.eval()
+
+            q_embs = []
+            for batch_start in tqdm(
+                range(0, len(queries), batch_size), desc="Encoding queries"
+            ):
+                q_seqs = self.tokenizer(
+                    list(queries[batch_start : batch_start + batch_size]),
+                    padding="max_length",
+                    truncation=True,
+                    return_tensors="pt",
+                ).to("cuda")
+                q_embs.append(self.q_encoder(**q_seqs).to("cpu").numpy())
+        q_embs = np.concatenate(q_embs).astype(np.float32)
+
+        doc_scores, doc_indices = self.indexer.search(q_embs, k)
+
+        # probe한 cluster에 후보가 k개보다 적으면 빈 slot이 -1로 남는데,
+        # reader는 질문마다 passage가 정확히 k개라고 가정하므로 결과를
+        # 직사각형으로 유지해야 함 - 모자란 query만 전체 cluster로 재검색
+        missing = (doc_indices == -1).any(axis=1)
+        if missing.any():
+            prev_nprobe = self.indexer.nprobe
+            self.indexer.nprobe = self.indexer.nlist
+            doc_scores[missing], doc_indices[missing] = self.indexer.search(
+                q_embs[missing], k
+            )
+            self.indexer.nprobe = prev_nprobe
+            if (doc_indices == -1).any():
+                raise ValueError(
+                    f"Dense index returned fewer than k={k} passages for some "
+                    "queries even with exhaustive nprobe."
+                )
+        return doc_scores, doc_indices
+
     # wiki context에서 query와 유사한 k개의 문서를 반환해주는 함수
     def get_relevant_docs(self, query, k):
         with torch.no_grad():
@@ -481,23 +556,33 @@ class DenseRetriever:
         output_dir="./outputs",
     ):
         print(f"Using split : {self.retrieval_split}")
+
+        # IVF-PQ 인덱스로 전체 query를 한 번에 검색 (exhaustive matmul 대체)
+        if self.indexer is None:
+            self.build_faiss()
+        doc_scores, doc_indices = self.get_relevant_docs_bulk(
+            query_or_dataset["question"], topk
+        )
+
         total = []
-        for example in tqdm(query_or_dataset, desc="Dense Retrieval"):
+        for idx, example in enumerate(tqdm(query_or_dataset, desc="Dense Retrieval")):
+            # get_relevant_docs_bulk가 -1 없는 직사각형 결과를 보장하므로
+            # 질문마다 정확히 topk개의 passage가 들어감
+            relevant_docs = [self.contexts[pid] for pid in doc_indices[idx]]
             tmp = {
                 "question": example["question"],
                 "id": example["id"],
-                "context": self.get_relevant_docs(example["question"], topk)[0]
+                "context": relevant_docs
                 if self.retrieval_split
-                else " ".join(self.get_relevant_docs(example["question"], topk)[0]),
+                else " ".join(relevant_docs),
             }
             if "context" in example.keys() and "answers" in example.keys():
                 tmp["original_context"] = example["context"]
                 tmp["answers"] = example["answers"]
 
             # 평가를 위한 df column 만들어주기
-            relevant_doc_for_df = self.get_relevant_docs(example["question"], topk)[0]
-            for i in range(len(relevant_doc_for_df)):
-                tmp[f"context{i + 1}"] = relevant_doc_for_df[i]
+            for i in range(len(relevant_docs)):
+                tmp[f"context{i + 1}"] = relevant_docs[i]
 
             total.append(tmp)
 
@@ -27,7 +27,13 @@ from transformers import (
     TrainingArguments,
     set_seed,
 )
-from utils_qa import check_no_error, postprocess_qa_predictions
+from utils_qa import (
+    TokenizationCache,
+    check_no_error,
+    clean_answer,
+    postprocess_qa_predictions,
+    prepare_validation_features,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -77,10 +83,15 @@ def main():
         else model_args.model_name_or_path,
         use_fast=True,
     )
+    model_kwargs = {}
+    if model_args.load_in_8bit:
+        # bitsandbytes int8 양자화: 메모리 대역폭을 절반 이하로 줄여줍니다.
+        model_kwargs.update(load_in_8bit=True, device_map="auto")
     model = AutoModelForQuestionAnswering.from_pretrained(
         model_args.model_name_or_path,
         from_tf=bool(".ckpt" in model_args.model_name_or_path),
         config=config,
+        **model_kwargs,
     )
     if data_args.retrieval_split:
         print("Using split retrieval")
@@ -200,7 +211,10 @@ def run_sparse_retrieval(
         )
         df = df[["answers", "context", "id", "question"]]
 
-    datasets = DatasetDict({"validation": Dataset.from_pandas(df, features=f)})
+    # pandas block 왕복 없이 dict of lists로 바로 Dataset 구성
+    datasets = DatasetDict(
+        {"validation": Dataset.from_dict(df.to_dict(orient="list"), features=f)}
+    )
     return datasets
 
 
@@ -278,8 +292,11 @@ def run_dense_retrieval(
         )
         df = df[["answers", "context", "id", "question"]]
 
-    df.to_csv("./dense_retrieval_result.csv", index=False)
-    datasets = DatasetDict({"validation": Dataset.from_pandas(df, features=f)})
+    # pandas block 왕복 없이 dict of lists로 바로 Dataset 구성
+    # (csv 저장이 필요하면 --retrieval_result_save로 retriever 쪽에서 저장)
+    datasets = DatasetDict(
+        {"validation": Dataset.from_dict(df.to_dict(orient="list"), features=f)}
+    )
     return datasets
 
 
@@ -307,50 +324,21 @@ def run_mrc(
         data_args, training_args, datasets, tokenizer
     )
 
-    # Validation preprocessing / 전처리를 진행합니다.
-    def prepare_validation_features(examples):
-        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
-        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
-        tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            stride=data_args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            return_token_type_ids=False,  # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
-            padding="max_length" if data_args.pad_to_max_length else False,
-        )
-
-        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-
-        # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
-        # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
-        tokenized_examples["example_id"] = []
-
-        for i in range(len(tokenized_examples["input_ids"])):
-            # sequence id를 설정합니다 (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
-
-            # 하나의 example이 여러개의 span을 가질 수 있습니다.
-            sample_index = sample_mapping[i]
-            tokenized_examples["example_id"].append(examples["id"][sample_index])
-
-            # context의 일부가 아닌 offset_mapping을 None으로 설정하여 토큰 위치가 컨텍스트의 일부인지 여부를 쉽게 판별할 수 있습니다.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
-        return tokenized_examples
-
     eval_dataset = datasets["validation"]
 
     # Validation Feature 생성
+    # module-level 함수 + fn_kwargs 조합이라 fingerprint가 안정적이고 캐시가 재사용됩니다.
     eval_dataset = eval_dataset.map(
         prepare_validation_features,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "question_column_name": question_column_name,
+            "context_column_name": context_column_name,
+            "max_seq_length": max_seq_length,
+            "doc_stride": data_args.doc_stride,
+            "pad_on_right": pad_on_right,
+            "pad_to_max_length": data_args.pad_to_max_length,
+        },
         batched=True,
         num_proc=data_args.preprocessing_num_workers,
         remove_columns=column_names,
@@ -441,21 +429,20 @@ class QADataset(Dataset):
         self.input_ids = p_inputs["input_ids"]
         self.attention_mask = p_inputs["attention_mask"]
         self.offset_mapping = p_inputs["offset_mapping"]
-        self.original_context_idx = p_inputs["original_context_idx"]
 
     def __len__(self):
         return len(self.input_ids)
 
     def __getitem__(self, index):
-        input_ids = self.input_ids[index].to("cuda")
-        attention_mask = self.attention_mask[index].to("cuda")
-        offset_mapping = self.offset_mapping[index].to("cuda")
-        original_context_idx = self.original_context_idx[index]
+        # padding과 GPU 전송은 collate/배치 단계에서 하므로 여기서는 그대로 반환
+        # (질문/passage 순번은 chunk 단위 배열로 따로 들고 있으므로 여기엔 없음)
+        input_ids = self.input_ids[index]
+        attention_mask = self.attention_mask[index]
+        offset_mapping = self.offset_mapping[index]
         item = {
             "input_ids": input_ids,
             "attention_mask": attention_mask,
             "offset_mapping": offset_mapping,
-            "original_context_idx": original_context_idx,
         }
         return item
 
@@ -464,7 +451,8 @@ import os
 import torch
 from tqdm import tqdm
 from torch.utils.data import DataLoader
-import re
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import json
 
 
@@ -472,169 +460,374 @@ def run_split_mrc(data_args, training_args, model_args, datasets, tokenizer, mod
     questions = datasets["validation"]["question"]
     contexts = datasets["validation"]["context"]
     q_ids = datasets["validation"]["id"]
-    model = model.to("cuda").eval()
+    # 8bit로 로드된 모델은 device_map으로 이미 GPU에 있고 .to()를 지원하지 않음
+    if not getattr(model, "is_loaded_in_8bit", False):
+        model = model.to("cuda")
+    model = model.eval()
+
+    # --torch_compile 플래그가 켜져 있으면 kernel fusion을 위해 컴파일 (torch 2.0+)
+    # reduce-overhead mode는 CUDA Graphs로 kernel launch overhead를 제거합니다.
+    # pad_to_multiple_of=8 덕에 배치 shape 종류가 적어 shape별 capture 비용이 작음
+    if training_args.torch_compile:
+        model = torch.compile(model, mode="reduce-overhead")
+
+    # fp16/bf16 플래그가 켜져 있으면 autocast로 저정밀도 추론
+    use_amp = training_args.fp16 or training_args.bf16
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+    # 배치 내 최대 길이까지만 padding하는 collate (tensor core를 위해 8의 배수로)
+    def collate_fn(features):
+        batch = tokenizer.pad(
+            [
+                {
+                    "input_ids": feature["input_ids"],
+                    "attention_mask": feature["attention_mask"],
+                }
+                for feature in features
+            ],
+            pad_to_multiple_of=8,
+            return_tensors="pt",
+        )
+        # offset은 모델 입력이 아니므로 GPU에 올리지 않고 (B, L, 2) numpy 배열로 유지
+        # (PAD 위치는 argmax에서 제외되므로 0으로 채워도 참조되지 않음)
+        max_len = batch["input_ids"].shape[1]
+        offsets = np.zeros((len(features), max_len, 2), dtype=np.int32)
+        for i, feature in enumerate(features):
+            offsets[i, : len(feature["offset_mapping"])] = feature["offset_mapping"]
+        batch["offset_mapping"] = offsets
+        return batch
+
     # 파라미터
     os.makedirs(training_args.output_dir, exist_ok=True)
     batch_size = 8
     topk = len(contexts[0])
+    mega_batch_size = 16  # 한 번에 토큰화/추론할 질문 개수
 
-    answer_dict = {}
-    n_best_dict = {}
     n_best_size = 20
-    p_bar = tqdm(range(len(datasets["validation"])))
-    for q_idx in p_bar:
-        # 테스트할 문항 하나씩 가져오기
-        answer = ""
-        query = questions[q_idx]
-        context = contexts[q_idx]  # [passage-1, passage-2 , ... , passage-k]
-
-        input_ids = None
-        attention_mask = None
-        offset_mapping = None
-        original_context_idx = []
-
-        # query와 각 context를 합쳐 각각 토큰화 후 하나의 tensor로 concat
+
+    # 답변을 dict에 전부 모아뒀다가 마지막에 dump하는 대신, 질문이 끝날 때마다
+    # 파일에 바로 이어 써서 n-best 결과가 메모리에 쌓이지 않게 함
+    pred_file = open(
+        os.path.join(training_args.output_dir, "predictions.json"),
+        "w",
+        encoding="utf-8",
+    )
+    nbest_file = open(
+        os.path.join(training_args.output_dir, "nbest_predictions.json"),
+        "w",
+        encoding="utf-8",
+    )
+    pred_file.write("{")
+    nbest_file.write("{")
+    num_written = 0
+
+    # 같은 retrieval 결과를 다시 돌릴 때 토큰화를 건너뛰기 위한 on-disk 캐시
+    tok_cache = TokenizationCache(
+        os.path.join(training_args.output_dir, "split_tok_cache.bin")
+    )
+
+    # unique passage당 한 번만 MRC tokenizer로 토큰화해서 재사용하는 캐시
+    # (retriever는 klue/bert-base로 따로 토큰화하므로 그 결과를 공유할 수는 없고,
+    #  여러 질문의 top-k에 같은 passage가 반복 등장하는 중복만 제거합니다)
+    unique_passages = {}
+    # pair 입력에서 special token이 들어가는 위치/개수를 미리 파악
+    # (build_inputs_with_special_tokens는 id 값을 검사하지 않으므로 marker 사용 가능)
+    marker = tokenizer.build_inputs_with_special_tokens([-1], [-2])
+    sp_prefix = marker.index(-1)
+    sp_mid = marker.index(-2) - sp_prefix - 1
+    sp_suffix = len(marker) - marker.index(-2) - 1
+    num_special = sp_prefix + sp_mid + sp_suffix
+
+    num_questions = len(datasets["validation"])
+
+    def tokenize_chunk(chunk_start):
+        # 테스트할 문항 mega_batch_size개씩 가져와서 feature로 조립
+        chunk_q_idx = range(
+            chunk_start, min(chunk_start + mega_batch_size, num_questions)
+        )
+        queries = [questions[q_idx] for q_idx in chunk_q_idx]
+        contexts_chunk = [contexts[q_idx] for q_idx in chunk_q_idx]
+
+        # chunk 안의 (query, passage) 쌍 feature를 캐시된 passage 토큰으로 조립
         # context끼리 concat 되는 일 없이 한 텐서 안에는 단일 passage만 존재
-        for k in range(topk):
-            tokens = tokenizer(
-                query,
-                context[k],
-                truncation="only_second",
-                max_length=data_args.max_seq_length,
-                stride=data_args.doc_stride,
-                return_overflowing_tokens=True,
-                padding="max_length",
-                return_tensors="pt",
-                return_offsets_mapping=True,
-            )
-            if k == 0:
-                input_ids = tokens["input_ids"]
-                attention_mask = tokens["attention_mask"]
-                offset_mapping = tokens["offset_mapping"]
-                # truncation 되면 여러 passage가 생기므로 그 개수만큼 context_idx 추가
-                original_context_idx.extend(
-                    [k for _ in range(len(tokens["input_ids"]))]
-                )
-            else:
-                input_ids = torch.concat((input_ids, tokens["input_ids"]))
-                attention_mask = torch.concat(
-                    (attention_mask, tokens["attention_mask"])
-                )
-                offset_mapping = torch.concat(
-                    (offset_mapping, tokens["offset_mapping"])
+        # NOTE: passage마다 반복되는 query prefix의 KV 재사용(prefix caching)은
+        # 양방향 encoder에서는 불가능 - query 토큰이 passage 토큰에도 attend 하므로
+        # passage가 바뀌면 query 위치의 hidden/KV states도 달라짐
+        flat_q = [query for query in queries for _ in range(topk)]
+        flat_c = [passage for context in contexts_chunk for passage in context]
+        cache_key = TokenizationCache.content_key(
+            tokenizer.name_or_path,
+            data_args.max_seq_length,
+            data_args.doc_stride,
+            flat_q,
+            flat_c,
+        )
+        tokens = tok_cache.get(cache_key)
+        if tokens is None:
+            # 아직 토큰화된 적 없는 passage만 골라 한 번의 batched 호출로 토큰화
+            new_passages = [
+                p for p in dict.fromkeys(flat_c) if p not in unique_passages
+            ]
+            if new_passages:
+                enc = tokenizer(
+                    new_passages,
+                    add_special_tokens=False,
+                    return_offsets_mapping=True,
                 )
-                original_context_idx.extend(
-                    [k for _ in range(len(tokens["input_ids"]))]
+                for i, passage in enumerate(new_passages):
+                    unique_passages[passage] = (
+                        enc["input_ids"][i],
+                        enc["offset_mapping"][i],
+                    )
+
+            # 질문은 pair당이 아니라 chunk당 한 번만 토큰화
+            q_enc = tokenizer(
+                queries, add_special_tokens=False, return_offsets_mapping=True
+            )
+
+            # 캐시된 passage 토큰을 stride window로 잘라 query 토큰 뒤에 붙이면
+            # tokenizer의 pair + overflow 인코딩과 같은 feature가 나옴
+            tokens = {
+                "input_ids": [],
+                "attention_mask": [],
+                "offset_mapping": [],
+                "overflow_to_sample_mapping": [],
+            }
+            for m, passage in enumerate(flat_c):
+                q_token_ids = q_enc["input_ids"][m // topk]
+                q_offsets = q_enc["offset_mapping"][m // topk]
+                ctx_ids, ctx_offsets = unique_passages[passage]
+                # query와 special token을 빼고 passage window가 쓸 수 있는 길이
+                cap = data_args.max_seq_length - len(q_token_ids) - num_special
+                # cap이 stride 이하면 window가 전진하지 못하므로 (같은 입력에서
+                # HF tokenizer도 에러) 무한 루프 대신 명시적으로 실패시킴
+                if cap <= data_args.doc_stride:
+                    raise ValueError(
+                        f"Question takes up too much of max_seq_length="
+                        f"{data_args.max_seq_length}: passage window size ({cap}) "
+                        f"must be larger than doc_stride ({data_args.doc_stride})."
+                    )
+                start = 0
+                while True:
+                    window_ids = ctx_ids[start : start + cap]
+                    input_ids = tokenizer.build_inputs_with_special_tokens(
+                        q_token_ids, window_ids
+                    )
+                    offsets = (
+                        [(0, 0)] * sp_prefix
+                        + q_offsets
+                        + [(0, 0)] * sp_mid
+                        + ctx_offsets[start : start + cap]
+                        + [(0, 0)] * sp_suffix
+                    )
+                    tokens["input_ids"].append(input_ids)
+                    tokens["attention_mask"].append([1] * len(input_ids))
+                    tokens["offset_mapping"].append(offsets)
+                    tokens["overflow_to_sample_mapping"].append(m)
+                    if start + cap >= len(ctx_ids):
+                        break
+                    start += cap - data_args.doc_stride
+            tok_cache.put(cache_key, tokens)
+        return chunk_q_idx, contexts_chunk, tokens
+
+    # 토큰화(CPU)와 model forward(GPU)가 겹치도록 다음 chunk의 토큰화는
+    # 백그라운드 스레드가 미리 수행하는 producer-consumer 구조
+    # (fast tokenizer는 thread-safe하지 않으므로 토큰화 스레드는 하나만 둡니다)
+    executor = ThreadPoolExecutor(max_workers=1)
+    chunk_starts = list(range(0, num_questions, mega_batch_size))
+    prefetch_depth = 2  # 미리 토큰화해 둘 chunk 개수 (bounded queue 역할)
+    pending = deque(
+        executor.submit(tokenize_chunk, chunk_start)
+        for chunk_start in chunk_starts[:prefetch_depth]
+    )
+
+    # H2D copy 전용 stream: pinned memory 복사가 이전 배치 forward와 겹칠 수 있게 함
+    copy_stream = torch.cuda.Stream()
+
+    p_bar = tqdm(range(len(chunk_starts)))
+    for chunk_idx in p_bar:
+        # 다음 chunk를 먼저 큐에 넣어 현재 chunk 추론 동안 토큰화가 진행되게 함
+        if chunk_idx + prefetch_depth < len(chunk_starts):
+            pending.append(
+                executor.submit(
+                    tokenize_chunk, chunk_starts[chunk_idx + prefetch_depth]
                 )
+            )
+        chunk_q_idx, contexts_chunk, tokens = pending.popleft().result()
+
+        # truncation 되면 여러 feature가 생기므로 overflow mapping으로부터
+        # (chunk 내 질문 순번, 원본 context 순번)을 복원
+        sample_mapping = tokens["overflow_to_sample_mapping"]
+        question_idx = [m // topk for m in sample_mapping]
+        original_context_idx = [m % topk for m in sample_mapping]
+
+        # 비슷한 길이끼리 배치되도록 길이순으로 정렬 (배치 내 padding 최소화)
+        # 결과는 question_idx 기준으로 scatter하므로 순서 복원은 필요 없음
+        order = sorted(
+            range(len(tokens["input_ids"])),
+            key=lambda i: len(tokens["input_ids"][i]),
+        )
 
         # 입력 데이터 구성
         input_data = {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "offset_mapping": offset_mapping,
-            "original_context_idx": original_context_idx,
+            "input_ids": [tokens["input_ids"][i] for i in order],
+            "attention_mask": [tokens["attention_mask"][i] for i in order],
+            "offset_mapping": [tokens["offset_mapping"][i] for i in order],
         }
 
+        # feature별 결과를 담을 배열은 chunk당 feature 수를 이미 알고 있으므로
+        # 한 번에 할당해 두고 배치마다 slice로 기록 (append로 늘리지 않음)
+        num_features = len(order)
+        all_q_idx = np.array([question_idx[i] for i in order])
+        all_c_idx = np.array([original_context_idx[i] for i in order])
+        all_s_vals = np.empty(num_features, dtype=np.float32)
+        all_e_vals = np.empty(num_features, dtype=np.float32)
+        all_s_pos = np.empty(num_features, dtype=np.int32)
+        all_e_pos = np.empty(num_features, dtype=np.int32)
+
         # 데이터셋 및 데이터로더 구성
+        # pin_memory로 H2D copy가 compute와 겹칠 수 있게 함
         valid_dataset = QADataset(input_data)
-        valid_dataloader = DataLoader(valid_dataset, batch_size=batch_size)
-        n_best_list = []
-        max_logit = 0
+        valid_dataloader = DataLoader(
+            valid_dataset,
+            batch_size=batch_size,
+            pin_memory=True,
+            num_workers=2,
+            collate_fn=collate_fn,
+        )
+
         for batch_idx, batch in enumerate(valid_dataloader):
             # 모델에 안 들어가도 될 입력(답변 구할 때 필요한 정보)은 pop하여 빼주기
-            original_context_idx = batch.pop("original_context_idx")
             offset_mapping = batch.pop("offset_mapping")
 
-            # 모델 forward
-            outputs = model(**batch)
+            # 모델 입력만 copy 전용 stream에서 비동기 GPU 전송
+            with torch.cuda.stream(copy_stream):
+                batch = {
+                    k: v.to("cuda", non_blocking=True)
+                    for k, v in batch.items()
+                    if torch.is_tensor(v)
+                }
+            # forward가 전송이 끝난 뒤에 시작하도록 default stream이 copy를 기다림
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            # copy_stream에서 할당된 메모리를 default stream 사용이 끝나기 전에
+            # allocator가 재사용하지 않도록 표시
+            for value in batch.values():
+                value.record_stream(torch.cuda.current_stream())
+
+            # 모델 forward (autograd bookkeeping 없이, 필요시 저정밀도로)
+            with torch.inference_mode(), torch.cuda.amp.autocast(
+                enabled=use_amp, dtype=amp_dtype
+            ):
+                outputs = model(**batch)
 
             # 배치마다 담긴 길이가 다르므로 구해주기
             batch_len = len(outputs["start_logits"])
 
-            # 각 query+passage 쌍에서의 start와 end의 max, argmax 구하기
-            # 총 batch_len개의 max, argmax 존재
-            s_max = outputs["start_logits"].max(dim=1)
-            e_max = outputs["end_logits"].max(dim=1)
-
-            # 각 query+passage 쌍에서 답변 확률과 위치 구하기
-            for idx in range(batch_len):
-                # 원래 토큰으로 돌리기 위한 offset
-                offsets = offset_mapping[idx]
-
-                # span의 확률
-                start_logit = s_max.values[idx].item()
-                end_logit = e_max.values[idx].item()
-                logit = start_logit + end_logit
-                s_pos = offsets[s_max.indices[idx].item()][0]
-                e_pos = offsets[e_max.indices[idx].item()][1]
-                original_context = context[original_context_idx[idx]]
-                text = original_context[s_pos:e_pos]
-
-                result = {
-                    "start_logit": start_logit,
-                    "end_logit": end_logit,
-                    "text": text,
-                    "score": start_logit + end_logit,
-                }
-                n_best_list.append(result)
+            # 동적 padding이므로 PAD 위치의 logit은 max에서 제외
+            pad_mask = batch["attention_mask"] == 0
+            start_logits = outputs["start_logits"].masked_fill(pad_mask, float("-inf"))
+            end_logits = outputs["end_logits"].masked_fill(pad_mask, float("-inf"))
 
-                if max_logit < logit:
-                    # 답변의 길이가 0이거나 [CLS]토큰이 답변이 된 케이스들 제외
-                    if s_pos == e_pos:
-                        continue
-
-                    # 끝나는 위치가 시작점보다 앞에 위치한 케이스 제외
-                    if e_pos < s_pos:
-                        continue
-
-                    # 너무 긴 답변 제외
-                    if e_pos - s_pos > 30:
-                        continue
-
-                    max_logit = logit
-                    answer = original_context[s_pos:e_pos]
+            # 각 query+passage 쌍에서의 start와 end의 max, argmax 구하기
+            # max/argmax는 GPU에서 계산하고 GPU→CPU 동기화는 배치당 한 번만 발생
+            s_vals, s_idx = start_logits.max(dim=1)
+            e_vals, e_idx = end_logits.max(dim=1)
+            s_vals = s_vals.float().cpu().numpy()
+            e_vals = e_vals.float().cpu().numpy()
+            s_idx = s_idx.cpu().numpy()
+            e_idx = e_idx.cpu().numpy()
+
+            # argmax 위치를 offset으로 char 단위 span으로 변환 (fancy-index gather)
+            s_pos = offset_mapping[np.arange(batch_len), s_idx, 0]
+            e_pos = offset_mapping[np.arange(batch_len), e_idx, 1]
+
+            # DataLoader가 dataset 순서대로 배치를 주므로 기록 위치는 batch_idx로 결정
+            write_start = batch_idx * batch_size
+            write_end = write_start + batch_len
+            all_s_vals[write_start:write_end] = s_vals
+            all_e_vals[write_start:write_end] = e_vals
+            all_s_pos[write_start:write_end] = s_pos
+            all_e_pos[write_start:write_end] = e_pos
+
+        # 답변으로 쓸 수 있는 span인지 boolean mask로 한 번에 판정
+        # (길이 0 / [CLS] / 역순 / 너무 긴 답변 제외)
+        all_logits = all_s_vals + all_e_vals
+        all_valid = (
+            (all_s_pos != all_e_pos)
+            & (all_s_pos <= all_e_pos)
+            & (all_e_pos - all_s_pos <= 30)
+        )
 
-        # GPU 공간을 위해 cache 비워주기
-        torch.cuda.empty_cache()
+        # chunk 안의 질문별로 답변 후처리 및 n-best 계산
+        # (원문 slicing은 최종 답변과 top-k 후보에 대해서만 수행)
+        for q_local, q_idx in enumerate(chunk_q_idx):
+            feat_idx = np.nonzero(all_q_idx == q_local)[0]
+
+            # valid한 feature 중 가장 logit이 큰 span을 답변으로 사용
+            answer = ""
+            valid_idx = feat_idx[all_valid[feat_idx]]
+            if len(valid_idx) > 0:
+                best = valid_idx[np.argmax(all_logits[valid_idx])]
+                if all_logits[best] > 0.0:
+                    original_context = contexts_chunk[q_local][all_c_idx[best]]
+                    answer = original_context[all_s_pos[best] : all_e_pos[best]]
+            answer = clean_answer(answer)
+
+            # 전체 정렬 대신 argpartition으로 O(N) top-k 후 살아남은 것들만 정렬
+            scores = all_logits[feat_idx]
+            keep = min(n_best_size, len(feat_idx))
+            top_idx = np.argpartition(-scores, keep - 1)[:keep]
+            top_idx = top_idx[np.argsort(-scores[top_idx])]
+            top_feats = feat_idx[top_idx]
+
+            # softmax도 top-k에 대해서만 벡터 연산으로 계산
+            top_scores = scores[top_idx]
+            exp_scores = np.exp(top_scores - top_scores.max())
+            probs = exp_scores / exp_scores.sum()
+
+            predictions = [
+                {
+                    "start_logit": float(all_s_vals[feat]),
+                    "end_logit": float(all_e_vals[feat]),
+                    "text": contexts_chunk[q_local][all_c_idx[feat]][
+                        all_s_pos[feat] : all_e_pos[feat]
+                    ],
+                    "probability": float(prob),
+                }
+                for prob, feat in zip(probs, top_feats)
+            ]
 
-        # answer 후처리
-        answer = answer.strip()
-        answer = re.sub(r"\\", "", answer)
-        answer = re.sub(r'""?', '"', answer)
-        answer = re.sub(r'^"|"$', "", answer)
+            # 질문 하나가 끝날 때마다 결과를 바로 파일에 이어쓰기
+            # (한 항목짜리 dict를 dump한 뒤 바깥 중괄호만 떼고 붙임)
+            sep = "," if num_written else ""
+            pred_file.write(
+                sep
+                + json.dumps({q_ids[q_idx]: answer}, indent=4, ensure_ascii=False)[1:-2]
+            )
+            nbest_file.write(
+                sep
+                + json.dumps({q_ids[q_idx]: predictions}, indent=4, ensure_ascii=False)[
+                    1:-2
+                ]
+            )
+            num_written += 1
 
         # 진행 상황 볼 수 있게 postfix로 답변 보여주기
         p_bar.set_postfix(answer=answer)
-        # n_best_list.sort(key=lambda x: x["score"])
-        # n_best_list = n_best_list[:n_best_size]
-        predictions = sorted(n_best_list, key=lambda x: x["score"], reverse=True)[
-            :n_best_size
-        ]
 
-        scores = np.array([x.pop("score") for x in predictions])
-        exp_scores = np.exp(scores - np.max(scores))
-        probs = exp_scores / exp_scores.sum()
+    executor.shutdown()
 
-        for prob, pred in zip(probs, predictions):
-            pred["probability"] = prob
+    # empty_cache()는 매번 호출하면 GPU sync로 오히려 느려지므로 마지막에 한 번만
+    torch.cuda.empty_cache()
 
-        # 답변 추가하기
-        answer_dict[q_ids[q_idx]] = answer
-        n_best_dict[q_ids[q_idx]] = predictions
+    # 새로 토큰화한 chunk가 있으면 캐시 저장
+    tok_cache.save()
 
-    # 답변 저장하기
-    with open(
-        os.path.join(training_args.output_dir, "predictions.json"),
-        "w",
-        encoding="utf-8",
-    ) as f:
-        json.dump(answer_dict, f, indent=4, ensure_ascii=False)
-    with open(
-        os.path.join(training_args.output_dir, "nbest_predictions.json"),
-        "w",
-        encoding="utf-8",
-    ) as f:
-        json.dump(n_best_dict, f, indent=4, ensure_ascii=False)
+    # 답변은 이미 다 기록되었으므로 닫는 중괄호만 마무리
+    pred_file.write("\n}")
+    nbest_file.write("\n}")
+    pred_file.close()
+    nbest_file.close()
 
 
 if __name__ == "__main__":
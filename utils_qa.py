@@ -17,9 +17,11 @@ Pre-processing
 Post-processing utilities for question answering.
 """
 import collections
+import hashlib
 import json
 import logging
 import os
+import pickle
 import random
 from typing import Any, Optional, Tuple
 
@@ -51,6 +53,124 @@ def set_seed(seed: int = 42):
         torch.backends.cudnn.benchmark = False
 
 
+def prepare_validation_features(
+    examples,
+    tokenizer,
+    question_column_name,
+    context_column_name,
+    max_seq_length,
+    doc_stride,
+    pad_on_right,
+    pad_to_max_length,
+):
+    """
+    Validation preprocessing / 전처리를 진행합니다.
+
+    closure가 아닌 module-level 함수로 두고 설정값을 fn_kwargs로 넘겨야
+    datasets의 fingerprint가 실행마다 동일해져 .map() 캐시가 재사용됩니다.
+    """
+    # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
+    # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
+    tokenized_examples = tokenizer(
+        examples[question_column_name if pad_on_right else context_column_name],
+        examples[context_column_name if pad_on_right else question_column_name],
+        truncation="only_second" if pad_on_right else "only_first",
+        max_length=max_seq_length,
+        stride=doc_stride,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        return_token_type_ids=False,  # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
+        padding="max_length" if pad_to_max_length else False,
+    )
+
+    # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
+    sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+
+    # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
+    # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
+    tokenized_examples["example_id"] = []
+
+    for i in range(len(tokenized_examples["input_ids"])):
+        # sequence id를 설정합니다 (to know what is the context and what is the question).
+        sequence_ids = tokenized_examples.sequence_ids(i)
+        context_index = 1 if pad_on_right else 0
+
+        # 하나의 example이 여러개의 span을 가질 수 있습니다.
+        sample_index = sample_mapping[i]
+        tokenized_examples["example_id"].append(examples["id"][sample_index])
+
+        # context의 일부가 아닌 offset_mapping을 None으로 설정하여 토큰 위치가 컨텍스트의 일부인지 여부를 쉽게 판별할 수 있습니다.
+        tokenized_examples["offset_mapping"][i] = [
+            (o if sequence_ids[k] == context_index else None)
+            for k, o in enumerate(tokenized_examples["offset_mapping"][i])
+        ]
+    return tokenized_examples
+
+
+class TokenizationCache:
+    """
+    토큰화 결과를 (내용 hash → 결과) 형태로 pickle에 저장해 두는 캐시
+
+    같은 passage들을 다시 토큰화하는 경우 (재실행 포함) 저장된 결과를 불러와
+    tokenizer 호출을 건너뜁니다.
+
+    Args:
+        cache_path (:obj:`str`): 캐시 pickle 파일 경로
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.dirty = False
+        if os.path.isfile(cache_path):
+            with open(cache_path, "rb") as file:
+                self.cache = pickle.load(file)
+            print(f"Tokenization cache loaded. ({len(self.cache)} entries)")
+        else:
+            self.cache = {}
+
+    @staticmethod
+    def content_key(*parts):
+        # 토큰화 입력과 설정값들을 합쳐 content hash 키를 만듭니다.
+        h = hashlib.md5()
+        for part in parts:
+            h.update(repr(part).encode("utf-8"))
+        return h.digest()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.dirty = True
+
+    def save(self):
+        # 새로 추가된 항목이 있을 때만 다시 저장합니다.
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        with open(self.cache_path, "wb") as file:
+            pickle.dump(self.cache, file)
+        self.dirty = False
+        print(f"Tokenization cache saved at {self.cache_path}.")
+
+
+def clean_answer(answer: str) -> str:
+    """
+    추출된 answer에서 backslash를 지우고 중복된/가장자리 따옴표를 정리합니다.
+
+    짧은 문자열에는 regex engine보다 C level의 str method들이 훨씬 빠르므로
+    str.replace / slicing으로 같은 규칙을 적용합니다.
+    """
+    answer = answer.strip()
+    answer = answer.replace("\\", "")
+    answer = answer.replace('""', '"')
+    if answer.startswith('"'):
+        answer = answer[1:]
+    if answer.endswith('"'):
+        answer = answer[:-1]
+    return answer
+
+
 def postprocess_qa_predictions(
     examples,
     features,